@@ -1,143 +1,182 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import Body, FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
-import json
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
+import orjson
+import ormsgpack
 import logging
+import os
+from contextlib import asynccontextmanager
 from typing import List, Dict, Any
-import base64
+import binascii
+import hashlib
+import hmac
+
+from models import AICleanupResponse, is_drawing_action
+from ws import ConnectionManager, RedisBroker, receive_frame
 
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="AI Diagramming Tool", version="1.0.0")
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+class ORJSONResponse(Response):
+    media_type = "application/json"
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:5173","http://localhost:3000", "http://localhost:8000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
-users_db = {
-    "demo@example.com": "password123"
-}
 
-class LoginRequest(BaseModel):
-    email: str
-    password: str
+# -------------------- CONNECTION MANAGER --------------------
+manager = ConnectionManager()
 
-class RegisterRequest(BaseModel):
-    email: str
-    password: str
+# Enables the cross-worker relay (see ws.RedisBroker) and multi-worker mode.
+REDIS_URL = os.environ.get("REDIS_URL")
 
 
-class DrawingAction(BaseModel):
-    type: str
-    x: float
-    y: float
-    prevX: float = None
-    prevY: float = None
-    color: str = "#000000"
-    lineWidth: int = 2
-    timestamp: float
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if REDIS_URL:
+        manager.broker = RedisBroker(REDIS_URL)
+        await manager.broker.start(manager.send_local)
+        # Seed the shared store too; HSETNX leaves an existing entry alone.
+        await create_user(DEMO_EMAIL, DEMO_PASSWORD)
+    try:
+        yield
+    finally:
+        if manager.broker is not None:
+            await manager.broker.close()
+
 
-class AICleanupRequest(BaseModel):
-    image_data: str
+app = FastAPI(title="AI Diagramming Tool", version="1.0.0",
+              default_response_class=ORJSONResponse, lifespan=lifespan)
 
-class AICleanupResponse:
-    def __init__(self, commands: List[Dict[str, Any]], success: bool, message: str):
-        self.commands = commands
-        self.success = success
-        self.message = message
+app.mount("/static", StaticFiles(directory="static"), name="static")
 
-    def to_dict(self):
-        return {
-            "commands": self.commands,
-            "success": self.success,
-            "message": self.message
-        }
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:5173","http://localhost:3000", "http://localhost:8000"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
+def hash_password(password: str) -> bytes:
+    return hashlib.sha256(password.encode()).digest()
 
-# -------------------- CONNECTION MANAGER --------------------
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+# Users are stored column-wise: an email -> row index map plus one list per
+# field, so new per-user fields become new parallel lists.
+_email_to_idx: Dict[str, int] = {}
+_pw_hashes: List[bytes] = []
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        logger.info(f"Client connected. Total connections: {len(self.active_connections)}")
+def add_user(email: str, password: str):
+    _email_to_idx[email] = len(_pw_hashes)
+    _pw_hashes.append(hash_password(password))
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        logger.info(f"Client disconnected. Total connections: {len(self.active_connections)}")
+DEMO_EMAIL, DEMO_PASSWORD = "demo@example.com", "password123"
+add_user(DEMO_EMAIL, DEMO_PASSWORD)
 
-    async def broadcast(self, message: dict, sender: WebSocket = None):
+# With the broker on, requests are spread across workers that each hold their
+# own copy of the lists above, so users live in a shared Redis hash
+# (email -> password digest) instead.
+USERS_KEY = "diagram:users"
 
-        if not self.active_connections:
-            return
-        
-        message_str = json.dumps(message)
-        disconnected = []
 
-        for connection in self.active_connections:
-            if connection != sender:
-                try:
-                    await connection.send_text(message_str)
-                except Exception as e:
-                    logger.error(f"Error sending message to client: {e}")
-                    disconnected.append(connection)
+async def create_user(email: str, password: str) -> bool:
+    """Register a user; returns False if the email is already taken."""
+    if manager.broker is not None:
+        return bool(await manager.broker.redis.hsetnx(USERS_KEY, email, hash_password(password)))
+    if email in _email_to_idx:
+        return False
+    add_user(email, password)
+    return True
 
-        for conn in disconnected:
-            self.disconnect(conn)
 
+async def check_password(email: str, password: str) -> bool:
+    if manager.broker is not None:
+        stored = await manager.broker.redis.hget(USERS_KEY, email)
+    else:
+        idx = _email_to_idx.get(email)
+        stored = None if idx is None else _pw_hashes[idx]
+    return stored is not None and hmac.compare_digest(stored, hash_password(password))
 
-manager = ConnectionManager()
 
 @app.websocket("/ws/draw")
 async def websocket_draw(websocket: WebSocket):
     await manager.connect(websocket)
     try:
         while True:
-            data = await websocket.receive_text()
+            data = await receive_frame(websocket)
             try:
-                drawing_data = json.loads(data)
-                await manager.broadcast(drawing_data, sender=websocket)
-            except json.JSONDecodeError:
+                # Parsed only to vet the frame before it is spliced into a
+                # batch and to read its type; the original frame is forwarded.
+                drawing_data = orjson.loads(data)
+            except orjson.JSONDecodeError:
                 print("⚠️ Received non-JSON:", data)
+                continue
+            action_type = drawing_data.get("type") if isinstance(drawing_data, dict) else None
+            # Any JSON value can show up here; only strings name an action type.
+            if not isinstance(action_type, str):
+                action_type = None
+            await manager.queue(data, sender=websocket, action_type=action_type)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 
+# Error replies are constant, so they are encoded once per wire format.
+_ERROR_MESSAGES = {
+    "invalid_json": {"error": "Invalid JSON format"},
+    "invalid_msgpack": {"error": "Invalid msgpack format"},
+    "processing": {"error": "Error processing drawing data"},
+}
+_ERRORS_JSON = {key: orjson.dumps(msg) for key, msg in _ERROR_MESSAGES.items()}
+_ERRORS_MSGPACK = {key: ormsgpack.packb(msg) for key, msg in _ERROR_MESSAGES.items()}
+
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, fmt: str = "json"):
+    use_msgpack = fmt == "msgpack"
+    errors = _ERRORS_MSGPACK if use_msgpack else _ERRORS_JSON
+    if use_msgpack:
+        decode, decode_error, invalid_format = (
+            ormsgpack.unpackb, ormsgpack.MsgpackDecodeError, errors["invalid_msgpack"])
+    else:
+        decode, decode_error, invalid_format = (
+            orjson.loads, orjson.JSONDecodeError, errors["invalid_json"])
+    await manager.connect(websocket, msgpack=use_msgpack)
     try:
         while True:
 
-            data = await websocket.receive_text()
+            data = await receive_frame(websocket)
+            # Only the decode is guarded here: MsgpackDecodeError is a plain
+            # ValueError, so a wider try would report unrelated failures from
+            # validation or fan-out as a format error.
+            try:
+                drawing_data = decode(data)
+            except decode_error:
+                await websocket.send_bytes(invalid_format)
+                continue
+
             try:
+                if not is_drawing_action(drawing_data):
+                    raise ValueError("Invalid drawing action")
 
-                drawing_data = json.loads(data)
-            
-                action = DrawingAction(**drawing_data)
+                if use_msgpack:
+                    data = orjson.dumps(drawing_data)
 
-                await manager.broadcast(drawing_data, sender=websocket)
+                await manager.queue(data, sender=websocket,
+                                    action_type=drawing_data["type"])
 
-            except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({"error": "Invalid JSON format"}))
             except Exception as e:
                 logger.error(f"Error processing drawing data: {e}")
-                await websocket.send_text(json.dumps({"error": "Error processing drawing data"}))
+                await websocket.send_bytes(errors["processing"])
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 
@@ -147,17 +186,16 @@ async def home_page():
     return FileResponse("static/index.html")
 
 @app.post("/register")
-async def register_user(user: RegisterRequest):
-    if user.email in users_db:
+async def register_user(email: str = Body(...), password: str = Body(...)):
+    if not await create_user(email, password):
         return {"success": False, "message": "Email already registered!"}
-    users_db[user.email] = user.password
     return {"success": True, "message": "Registration successful! Please login."}
 
 @app.post("/login")
-async def login_user(user: LoginRequest):
-    if user.email not in users_db or users_db[user.email] != user.password:
-        return {"success": False, "message": "Invalid email or password!"}
-    return {"success": True, "message": "Login successful!"}
+async def login_user(email: str = Body(...), password: str = Body(...)):
+    if not await check_password(email, password):
+        return ORJSONResponse({"success": False, "message": "Invalid email or password!"})
+    return ORJSONResponse({"success": True, "message": "Login successful!"})
 
 @app.get("/login")
 async def login_page():
@@ -168,24 +206,10 @@ async def register_page():
     return FileResponse("static/register.html")
 
 
-@app.post("/ai/cleanup", response_model=dict)
-async def ai_cleanup(request: AICleanupRequest):
-
-    try:
-        base64.b64decode(request.image_data)
-    except Exception as e:
-        logger.error(f"Failed to decode image: {e}")
-        raise HTTPException(status_code=400, detail="Invalid image data")
-    
-    process_steps = ["Start", "Process", "End"]
-    commands = []
-    x, y = 50, 50
-    width, height = 200, 100
-    spacing = 50
-
-    for i, step in enumerate(process_steps):
-
-        commands.append({
+def _steps_for(step: str, x: int, y: int, width: int, height: int,
+               spacing: int, connect: bool) -> List[Dict[str, Any]]:
+    commands = [
+        {
             "type": "rectangle",
             "x": x,
             "y": y,
@@ -193,41 +217,87 @@ async def ai_cleanup(request: AICleanupRequest):
             "height": height,
             "color": "#000000",
             "lineWidth": 2
-        })
-
-        commands.append({
+        },
+        {
             "type": "text",
             "x": x + width // 2,
             "y": y + height // 2 + 5,
             "text": step,
             "fontSize": 14,
             "color": "#000000"
+        },
+    ]
+    if connect:
+        commands.append({
+            "type": "line",
+            "startX": x + width,
+            "startY": y + height // 2,
+            "endX": x + width + spacing,
+            "endY": y + height // 2,
+            "color": "#000000",
+            "lineWidth": 2
         })
-        
+    return commands
+
+
+def _build_cleanup_commands(process_steps: List[str]) -> List[Dict[str, Any]]:
+    x0, y0 = 50, 50
+    width, height = 200, 100
+    spacing = 50
+    last = len(process_steps) - 1
+
+    return [
+        cmd
+        for i, step in enumerate(process_steps)
+        for cmd in _steps_for(step, x0 + i * (width + spacing), y0,
+                              width, height, spacing, connect=i < last)
+    ]
+
+
+# The cleanup result doesn't depend on the submitted image yet, so the
+# response body is serialized once at import time.
+_AI_CLEANUP_BODY = orjson.dumps(
+    AICleanupResponse(commands=_build_cleanup_commands(["Start", "Process", "End"]),
+                      success=True,
+                      message="Diagram cleaned successfully").to_dict()
+)
+
 
-        if i < len(process_steps) - 1:
-            commands.append({
-                "type": "line",
-                "startX": x + width,
-                "startY": y + height // 2,
-                "endX": x + width + spacing,
-                "endY": y + height // 2,
-                "color": "#000000",
-                "lineWidth": 2
-            })
+_BASE64_CHUNK = 64 * 1024  # multiple of 4 so chunks align with base64 quads
 
 
-        x += width + spacing
+def validate_base64(data: str) -> None:
+    """Raise ValueError if data isn't strict base64, without keeping the decoded bytes."""
+    last = len(data) - _BASE64_CHUNK
+    for start in range(0, len(data), _BASE64_CHUNK):
+        chunk = data[start:start + _BASE64_CHUNK]
+        # Padding is only legal at the very end of the input.
+        if start < last and chunk.endswith("="):
+            raise binascii.Error("Excess data after padding")
+        binascii.a2b_base64(chunk, strict_mode=True)
+
+
+@app.post("/ai/cleanup", response_model=dict)
+async def ai_cleanup(image_data: str = Body(..., embed=True)):
+
+    try:
+        await run_in_threadpool(validate_base64, image_data)
+    except ValueError as e:
+        logger.error(f"Failed to decode image: {e}")
+        raise HTTPException(status_code=400, detail="Invalid image data")
 
-    return AICleanupResponse(commands=commands, success=True,
-                             message="Diagram cleaned successfully").to_dict()
+    return Response(content=_AI_CLEANUP_BODY, media_type="application/json")
 
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "active_connections": len(manager.active_connections)}
+    return ORJSONResponse({"status": "healthy",
+                           "active_connections": len(manager.active_connections)})
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Without a broker, clients on different workers couldn't see each other.
+    workers = (os.cpu_count() or 1) if REDIS_URL else 1
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers,
+                loop="uvloop", http="httptools", ws="websockets-sansio")
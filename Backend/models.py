@@ -0,0 +1,38 @@
+from pydantic import BaseModel
+from typing import List, Dict, Any
+
+
+# Documents the /ws message shape; the handler checks the required fields
+# by hand via is_drawing_action() to avoid a model build per message.
+class DrawingAction(BaseModel):
+    type: str
+    x: float
+    y: float
+    prevX: float = None
+    prevY: float = None
+    color: str = "#000000"
+    lineWidth: int = 2
+    timestamp: float
+
+class AICleanupResponse:
+    def __init__(self, commands: List[Dict[str, Any]], success: bool, message: str):
+        self.commands = commands
+        self.success = success
+        self.message = message
+
+    def to_dict(self):
+        return {
+            "commands": self.commands,
+            "success": self.success,
+            "message": self.message
+        }
+
+
+def is_drawing_action(data: Any) -> bool:
+    return (
+        isinstance(data, dict)
+        and isinstance(data.get("type"), str)
+        and isinstance(data.get("x"), (int, float))
+        and isinstance(data.get("y"), (int, float))
+        and isinstance(data.get("timestamp"), (int, float))
+    )
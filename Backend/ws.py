@@ -0,0 +1,236 @@
+from fastapi import WebSocket, WebSocketDisconnect
+import orjson
+import ormsgpack
+import asyncio
+import logging
+import uuid
+from typing import List, Dict, Any, Set, Union
+
+
+logger = logging.getLogger(__name__)
+
+
+# -------------------- CONNECTION MANAGER --------------------
+# Drawing actions from one sender arriving within this window (seconds) are
+# coalesced into a single {"type": "batch", "actions": [...]} frame.
+BATCH_WINDOW = 0.005
+# Latency-sensitive actions bypass the batching window.
+UNBATCHED_TYPES = frozenset({"clear", "move"})
+
+
+class ConnectionManager:
+    def __init__(self):
+        # Handlers call disconnect() in a finally block, so every exit path
+        # removes its socket from these sets.
+        self.active_connections: Set[WebSocket] = set()
+        # Clients that opted into the msgpack wire format; everyone else gets JSON.
+        self.msgpack_connections: Set[WebSocket] = set()
+        self.pending: Dict[WebSocket, List[bytes]] = {}
+        self._flush_tasks: Set[asyncio.Task] = set()
+        # Set on startup when REDIS_URL is configured (see RedisBroker).
+        self.broker = None
+
+    async def connect(self, websocket: WebSocket, msgpack: bool = False):
+        await websocket.accept()
+        self.active_connections.add(websocket)
+        if msgpack:
+            self.msgpack_connections.add(websocket)
+        logger.info(f"Client connected. Total connections: {len(self.active_connections)}")
+
+    def disconnect(self, websocket: WebSocket):
+        self.active_connections.discard(websocket)
+        self.msgpack_connections.discard(websocket)
+        logger.info(f"Client disconnected. Total connections: {len(self.active_connections)}")
+
+    async def queue(self, raw: Union[str, bytes], sender: WebSocket, action_type: Any = None):
+        if action_type in UNBATCHED_TYPES:
+            # Deliver anything still buffered first so peers see actions in order.
+            await self.flush(sender)
+            await self.broadcast_raw(raw, sender=sender)
+            return
+
+        if isinstance(raw, str):
+            raw = raw.encode()
+        batch = self.pending.get(sender)
+        if batch is not None:
+            batch.append(raw)
+            return
+
+        self.pending[sender] = [raw]
+        task = asyncio.create_task(self._flush_later(sender))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush_later(self, sender: WebSocket):
+        await asyncio.sleep(BATCH_WINDOW)
+        await self.flush(sender)
+
+    async def flush(self, sender: WebSocket):
+        batch = self.pending.pop(sender, None)
+        if not batch:
+            return
+        if len(batch) == 1:
+            await self.broadcast_raw(batch[0], sender=sender)
+        else:
+            await self.broadcast_raw(
+                b'{"type":"batch","actions":[' + b",".join(batch) + b"]}", sender=sender
+            )
+
+    async def broadcast_raw(self, raw: Union[str, bytes], sender: WebSocket = None):
+        # Encode once here rather than letting every send_text() re-encode
+        # the same string; all fan-out below works on bytes.
+        if isinstance(raw, str):
+            raw = raw.encode()
+        if self.broker is not None:
+            # Queued for the broker's background publisher, so local fan-out
+            # never waits on a Redis round trip.
+            self.broker.publish(raw)
+        await self.send_local(raw, sender=sender)
+
+    async def send_local(self, raw: bytes, sender: WebSocket = None):
+
+        if not self.active_connections:
+            return
+
+        # Snapshot the targets so disconnects during the gather can't mutate
+        # the set we are iterating.
+        targets = [c for c in self.active_connections if c is not sender]
+        if not self.msgpack_connections:
+            # Common case: JSON-only clients, no per-target checks needed.
+            sends = [c.send_bytes(raw) for c in targets]
+        else:
+            # JSON is the relay format; transcode once per broadcast for msgpack
+            # clients, before any send is built so a failure can't strand them.
+            packed = None
+            if any(c in self.msgpack_connections for c in targets):
+                try:
+                    packed = ormsgpack.packb(orjson.loads(raw))
+                except (TypeError, ValueError) as e:
+                    # e.g. JSON nested deeper than ormsgpack's recursion limit;
+                    # JSON peers still get the frame.
+                    logger.error(f"Error encoding message for msgpack clients, skipping them: {e}")
+                    targets = [c for c in targets if c not in self.msgpack_connections]
+            sends = [
+                c.send_bytes(packed if c in self.msgpack_connections else raw)
+                for c in targets
+            ]
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        disconnected = []
+
+        for connection, result in zip(targets, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending message to client: {result}")
+                disconnected.append(connection)
+
+        for conn in disconnected:
+            self.disconnect(conn)
+
+
+# -------------------- CROSS-WORKER BROKER --------------------
+# With several worker processes each one only sees its own sockets, so every
+# broadcast is also published to Redis and relayed by the other workers.
+BROADCAST_CHANNEL = "diagram:broadcast"
+WORKER_ID = uuid.uuid4().hex.encode()
+
+
+class RedisBroker:
+    # Seconds to wait before resubscribing after the subscription breaks.
+    RESUBSCRIBE_DELAY = 1.0
+    # Outgoing messages buffered while Redis is slow or unreachable; beyond
+    # this, new messages are dropped rather than growing memory unbounded.
+    OUTBOX_SIZE = 1000
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url)
+        self._pubsub = None
+        self._listener = None
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=self.OUTBOX_SIZE)
+        self._publisher = None
+
+    async def start(self, deliver):
+        # Subscribe eagerly so a bad REDIS_URL fails startup instead of
+        # only showing up in the retry log.
+        await self._subscribe()
+        self._listener = asyncio.create_task(self._listen(deliver))
+        self._publisher = asyncio.create_task(self._publish_loop())
+
+    async def close(self):
+        for task in (self._listener, self._publisher):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self._drop_pubsub()
+        await self.redis.aclose()
+
+    def publish(self, raw: bytes):
+        try:
+            self._outbox.put_nowait(raw)
+        except asyncio.QueueFull:
+            logger.error("Redis publish backlog full, dropping message for other workers")
+
+    async def _publish_loop(self):
+        # A single consumer keeps messages in the order they were broadcast.
+        while True:
+            raw = await self._outbox.get()
+            try:
+                # Prefixed with the worker id so the publisher can skip its own echo.
+                await self.redis.publish(BROADCAST_CHANNEL, WORKER_ID + raw)
+            except Exception as e:
+                logger.error(f"Error publishing message to other workers: {e}")
+
+    async def _subscribe(self):
+        self._pubsub = self.redis.pubsub()
+        await self._pubsub.subscribe(BROADCAST_CHANNEL)
+
+    async def _drop_pubsub(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub is None:
+            return
+        try:
+            await pubsub.aclose()
+        except Exception as e:
+            logger.warning(f"Error closing Redis subscription: {e}")
+
+    async def _listen(self, deliver):
+        # Runs for the worker's lifetime: if the subscription breaks, log it
+        # and resubscribe rather than silently stop relaying other workers.
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                await self._relay(self._pubsub, deliver)
+                logger.warning("Redis subscription ended, resubscribing")
+            except Exception as e:
+                logger.error(f"Redis subscription failed, retrying in "
+                             f"{self.RESUBSCRIBE_DELAY}s: {e}")
+            await self._drop_pubsub()
+            await asyncio.sleep(self.RESUBSCRIBE_DELAY)
+
+    async def _relay(self, pubsub, deliver):
+        id_len = len(WORKER_ID)
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            data = message["data"]
+            if data[:id_len] == WORKER_ID:
+                continue
+            try:
+                await deliver(data[id_len:])
+            except Exception as e:
+                logger.error(f"Error relaying message from another worker: {e}")
+
+
+async def receive_frame(websocket: WebSocket) -> Union[str, bytes]:
+    """Receive the next text or binary frame without decoding it."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return message["bytes"]
+    return message["text"]
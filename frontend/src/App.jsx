@@ -1,6 +1,8 @@
 import React, { useRef, useEffect, useState } from 'react';
 import './App.css';
 
+const textDecoder = new TextDecoder();
+
 const App = () => {
   const canvasRef = useRef(null);
   const wsRef = useRef(null);
@@ -35,6 +37,8 @@ const App = () => {
   const connectWebSocket = () => {
     try {
       wsRef.current = new WebSocket('ws://localhost:8000/ws/draw');
+      // The server broadcasts pre-encoded JSON as binary frames
+      wsRef.current.binaryType = 'arraybuffer';
       
       wsRef.current.onopen = () => {
         console.log('Connected to WebSocket server');
@@ -42,8 +46,13 @@ const App = () => {
       };
       
       wsRef.current.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-        drawLine(data.prevX, data.prevY, data.x, data.y, data.color, false);
+        const text = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data);
+        const data = JSON.parse(text);
+        // Rapid strokes are coalesced by the server into batch frames
+        const actions = data.type === 'batch' ? data.actions : [data];
+        actions.forEach((action) => {
+          drawLine(action.prevX, action.prevY, action.x, action.y, action.color, false);
+        });
       };
       
       wsRef.current.onclose = () => {